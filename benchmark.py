@@ -0,0 +1,120 @@
+#coding:utf-8
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+from refine import SubtitleBlock, SubtitleRefiner
+from translate import SubtitleTranslator
+
+WORDS = ['hello', 'world', 'timeline', 'viewer', 'zoom', 'bin', 'clip', 'edit', 'the', 'a', 'to', 'and']
+CJK = ['媒体', '时间线', '检视器', '缩放', '剪辑', '你好']
+
+def make_srt(count: int, seed: int = 0) -> str:
+    """生成包含 count 条字幕的合成 SRT 文本，中英文混排，部分字幕首尾相接"""
+    rng = random.Random(seed)
+    blocks = []
+    start = 0
+    for idx in range(1, count + 1):
+        end = start + rng.choice([800, 1500, 2500])
+        words = [rng.choice(WORDS) for _ in range(rng.randint(2, 12))]
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), rng.choice(CJK))
+        text = ' '.join(words) + rng.choice(['', ',', '.', '。'])
+        blocks.append(f"{idx}\n{format_ms(start)} --> {format_ms(end)}\n{text}")
+        start = end + (0 if rng.random() < 0.6 else 500)
+    return '\n\n'.join(blocks) + '\n'
+
+def format_ms(ms: int) -> str:
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+def create_translator(workdir: Path, input_file: Path) -> SubtitleTranslator:
+    # 翻译器会在当前目录下创建缓存目录，放到临时目录中避免污染工作区
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return SubtitleTranslator(input_file=str(input_file), output_file=str(workdir / 'out.srt'), model_name='benchmark')
+    finally:
+        os.chdir(cwd)
+
+def build_cases(translator: SubtitleTranslator, refiner: SubtitleRefiner, content: str, path: Path) -> dict:
+    """返回 {基准名称: 无参函数}"""
+    subtitles = translator.parse_subtitle(content)
+    texts = [text for _, _, text in subtitles]
+    blocks = refiner.parse_subtitles(path)
+
+    def refine():
+        # refine 会修改字幕块，每次都从副本开始；合并日志输出到 devnull
+        copies = [SubtitleBlock(b.id, b.start, b.end, b.text) for b in blocks]
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            refiner.refine(copies)
+
+    return {
+        'parse_subtitle': lambda: translator.parse_subtitle(content),
+        'iter_subtitle_file': lambda: list(translator.iter_subtitle_file(path)),
+        'process_subtitle_blocks': lambda: translator._process_subtitle_blocks(subtitles),
+        'format_subtitles': lambda: '\n\n'.join(f'{num}\n{timestamp}\n{text}' for num, timestamp, text in subtitles),
+        'cache_key': lambda: translator._get_cache_key(content),
+        'word_count': lambda: [refiner.word_count(text) for text in texts],
+        'refine': refine,
+    }
+
+def run(sizes, only=None) -> dict:
+    results = {}
+    refiner = SubtitleRefiner(min_words=3, max_words=15, tolerance=100, merge_delimiter=' ')
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        for size in sizes:
+            path = workdir / f"bench_{size}.srt"
+            content = make_srt(size)
+            path.write_text(content, encoding='utf-8')
+            translator = create_translator(workdir, path)
+            for name, func in build_cases(translator, refiner, content, path).items():
+                if only and name not in only:
+                    continue
+                timer = timeit.Timer(func)
+                number, _ = timer.autorange()
+                seconds = min(timer.repeat(repeat=3, number=number)) / number
+                results[f"{name}[{size}]"] = seconds
+                print(f"{name:<24} {size:>7} 条  {seconds * 1000:10.3f} ms  {seconds / size * 1e6:8.3f} µs/条")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='解析与后处理热点函数的基准测试（不调用 LLM）')
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='合成字幕条数，逗号分隔(默认: 100,1000,10000,100000)')
+    parser.add_argument('--only', help='只运行指定的基准，逗号分隔')
+    parser.add_argument('--save', help='把结果保存为 JSON，作为之后比较的基线')
+    parser.add_argument('--compare', help='与之前保存的基线 JSON 比较')
+    parser.add_argument('--max-slowdown', type=float, default=1.2, help='相对基线允许的最大耗时倍数(默认: 1.2)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+    results = run(sizes, only)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2), encoding='utf-8')
+        print(f"基线已保存到: {args.save}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        regressions = []
+        for key, seconds in results.items():
+            if key not in baseline:
+                continue
+            ratio = seconds / baseline[key]
+            if ratio > args.max_slowdown:
+                regressions.append(f"{key}: {baseline[key] * 1000:.3f} ms -> {seconds * 1000:.3f} ms ({ratio:.2f}x)")
+        if regressions:
+            print("性能回退:")
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print("未发现性能回退")
+
+if __name__ == "__main__":
+    main()
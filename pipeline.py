@@ -0,0 +1,58 @@
+#coding:utf-8
+import argparse
+import asyncio
+
+from refine import SubtitleRefiner
+from translate import PROFILED_METHODS, SubtitleTranslator, add_translation_arguments, check_translation_arguments, translator_options_from_args
+
+def refined_subtitles(refiner, blocks):
+    """把优化后的字幕块转换成翻译器使用的 (序号, 时间戳, 文本内容)，并重新编号"""
+    idx = 0
+    for block in refiner.iter_refine(blocks):
+        # 合并后为空的字幕块在 SRT 中无法表示，直接跳过
+        if block.text.strip() == '':
+            continue
+        idx += 1
+        yield (str(idx), f"{block.start} --> {block.end}", block.text)
+
+async def main():
+    parser = argparse.ArgumentParser(description='字幕优化 + 翻译流水线')
+    parser.add_argument('input_file', help='输入字幕文件路径')
+    parser.add_argument('output_file', help='输出字幕文件路径')
+    parser.add_argument('model_name', help='模型名称')
+    parser.add_argument('--min-words', type=int, default=3)
+    parser.add_argument('--max-words', type=int, default=15)
+    parser.add_argument('--tolerance', type=int, default=100)
+    parser.add_argument('--merge-delimiter', type=str, default=' ')
+    parser.add_argument('--no-merge-delimiter', action='store_true')
+    add_translation_arguments(parser)
+    args = parser.parse_args()
+    check_translation_arguments(parser, args)
+    if args.no_merge_delimiter:
+        args.merge_delimiter = ''
+
+    refiner = SubtitleRefiner(min_words=args.min_words, max_words=args.max_words, tolerance=args.tolerance, merge_delimiter=args.merge_delimiter)
+    translator = SubtitleTranslator(
+        input_file=args.input_file,
+        output_file=args.output_file,
+        model_name=args.model_name,
+        **translator_options_from_args(args)
+    )
+
+    profiler = None
+    if args.profile:
+        from profiling import StageProfiler
+        profiler = StageProfiler(args.profile)
+        profiler.wrap_methods(refiner, ('parse_subtitles', 'word_count'), prefix='refine.')
+        profiler.wrap_methods(translator, PROFILED_METHODS)
+        profiler.start()
+    try:
+        blocks = refiner.parse_subtitles(args.input_file)
+        # 优化结果直接流入翻译队列，凑满一个分块即开始翻译
+        await translator.translate_stream(refined_subtitles(refiner, blocks))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+#coding:utf-8
+import cProfile
+import functools
+import io
+import pstats
+import time
+import tracemalloc
+from pathlib import Path
+
+class StageProfiler:
+    """按阶段统计本地 CPU 开销的分析器
+
+    start() 之后用 cProfile 记录整个运行过程，用 tracemalloc 跟踪内存分配；
+    wrap() 包装的同步函数会额外统计调用次数和累计耗时，便于和 LLM 的等待时间区分开。
+    """
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.stages = {}
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        tracemalloc.start()
+        self.profile.enable()
+
+    def wrap(self, name, func):
+        """包装同步函数，统计其调用次数和累计耗时"""
+        stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats['calls'] += 1
+                stats['seconds'] += time.perf_counter() - begin
+        return wrapper
+
+    def wrap_methods(self, obj, names, prefix=''):
+        """把对象上的若干方法替换为包装后的版本"""
+        for name in names:
+            setattr(obj, name, self.wrap(f"{prefix}{name}", getattr(obj, name)))
+
+    def stop(self):
+        """停止分析，打印各阶段耗时并把详细结果写入输出目录"""
+        self.profile.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.profile.dump_stats(self.output_dir / 'profile.prof')
+
+        lines = ["各阶段本地开销:"]
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            if not stats['calls']:
+                continue
+            lines.append(f"  {name}: 调用 {stats['calls']} 次, 共 {stats['seconds']*1000:.1f} ms, "
+                         f"平均 {stats['seconds']/stats['calls']*1e6:.1f} µs")
+        lines.append(f"内存: 当前 {current/1024/1024:.1f} MB, 峰值 {peak/1024/1024:.1f} MB")
+        lines.append("内存分配最多的位置:")
+        for stat in snapshot.statistics('lineno')[:10]:
+            lines.append(f"  {stat}")
+        report = '\n'.join(lines)
+        print(report)
+
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(30)
+        (self.output_dir / 'report.txt').write_text(report + '\n\n' + stream.getvalue(), encoding='utf-8')
+        print(f"分析结果已保存到: {self.output_dir}")
@@ -95,14 +95,16 @@ class SubtitleRefiner:
 
         return blocks
     def refine(self, blocks):
+        return list(self.iter_refine(blocks))
+    def iter_refine(self, blocks):
+        # 逐条产出已经确定不会再被合并的字幕，供下游流式处理
         idx = 0
         nextIdx = 1
-        refined_blocks = []
         while nextIdx < len(blocks):
             current = blocks[idx]
             next = blocks[nextIdx]
             if not current.is_continuous_with(next, self.tolerance):
-                refined_blocks.append(current)
+                yield current
                 idx = nextIdx
                 nextIdx = idx + 1
                 continue
@@ -114,7 +116,7 @@ class SubtitleRefiner:
             if self.word_count(current.text) + self.word_count(next_parts[0]) > self.max_words and \
                 self.word_count(next.text) + self.word_count(current_parts[len(current_parts)-1]) > self.max_words:
 
-                refined_blocks.append(current)
+                yield current
                 idx = nextIdx
                 nextIdx = idx + 1
                 continue
@@ -152,17 +154,16 @@ class SubtitleRefiner:
                 continue
             
             if current.text != '':
-                refined_blocks.append(current)
+                yield current
 
             idx = nextIdx
             nextIdx = idx + 1
 
         while idx < len(blocks):
             print("append last subtitle:", blocks[idx].text)
-            refined_blocks.append(blocks[idx])
+            yield blocks[idx]
             idx += 1
 
-        return refined_blocks
     def format_srt(self, blocks):
         return '\n'.join([f"{idx}\n{block.start} --> {block.end}\n{block.text}\n" for idx, block in enumerate(blocks, 1)])
 
@@ -1,17 +1,73 @@
 #coding:utf-8
 
 import asyncio
+import heapq
 import re
 from pathlib import Path
 from typing import List, Tuple
 import subprocess
 import logging
 import string
+import argparse
+import shelve
 
 import ollama
 
+# 各阶段的生成参数：think 为是否启用思考，num_predict 为最大生成 token 数，
+# 取 'auto' 时按预期输出的长度估算；num_ctx / keep_alive 为 None 时使用 ollama 的默认值
+DEFAULT_GENERATION_PROFILES = {
+    'translate': {
+        'think': True,
+        'temperature': 1.3,
+        'num_predict': 'auto',
+        'num_ctx': None,
+        'keep_alive': None,
+    },
+    'quality_check': {
+        'think': False,
+        'temperature': 1.3,
+        'num_predict': 'auto',
+        'num_ctx': None,
+        'keep_alive': None,
+    },
+}
+GENERATION_KEYS = ('think', 'temperature', 'num_predict', 'num_ctx', 'keep_alive')
+
+# num_predict 为 'auto' 时，在预期输出之外为思考过程预留的 token 数
+THINK_TOKEN_ALLOWANCE = {
+    False: 0,
+    True: 4096,
+    'low': 1024,
+    'medium': 2048,
+    'high': 4096,
+}
+
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+WORD_PATTERN = re.compile(r'[A-Za-z\u00c0-\u024f]+')
+OTHER_PATTERN = re.compile(r'[^\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaffA-Za-z\u00c0-\u024f\s]')
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数：中日韩字符约 1 个/字，拉丁文单词约 1.3 个/词，
+    数字和标点按 1 个/字符计（时间戳中的数字通常被逐位切分）"""
+    cjk = len(CJK_PATTERN.findall(text))
+    words = len(WORD_PATTERN.findall(text))
+    others = len(OTHER_PATTERN.findall(text))
+    return cjk + int(words * 1.3) + others
+
+# --profile 时统计耗时的本地处理函数
+PROFILED_METHODS = (
+    'parse_subtitle',
+    'validate_format',
+    '_process_subtitle_blocks',
+    '_get_cache_key',
+    '_save_cache',
+    '_save_quality_cache',
+    '_record_blocks',
+    '_write_ready',
+)
+
 class SubtitleTranslator:
-    def __init__(self, input_file: str, output_file: str, model_name: str, chunk_size: int = 30, max_concurrent: int = 10, context_size: int = 3, split_retry: int = 3, keep_punctuation: bool = False):
+    def __init__(self, input_file: str, output_file: str, model_name: str, chunk_size: int = 30, max_concurrent: int = 10, context_size: int = 3, split_retry: int = 3, keep_punctuation: bool = False, incremental: bool = False, generation_profiles: dict = None, max_in_flight: int = None, target_language: str = None, quality_threshold: float = 5.0, adaptive_threshold: bool = False, echo_context: bool = False):
         self.input_file = Path(input_file)
         self.output_file = Path(output_file)
         self.model_name = model_name
@@ -20,14 +76,50 @@ class SubtitleTranslator:
         self.context_size = context_size
         self.split_retry = split_retry
         self.keep_punctuation = keep_punctuation
+        self.incremental = incremental
+        self.max_in_flight = max_in_flight
+        self.target_language = target_language
+        self.label = f"[{target_language}] " if target_language else ""
+        # 已接受的译文 {序号: 译文}，供后续分块作为参考上下文，中转模式下也供其他语言使用
+        self.accepted_lines = {}
+        # 中转模式：pivot 为中转语言的翻译器
+        self.pivot = None
+        self.max_retries = 10
+        self.quality_threshold = quality_threshold
+        self.adaptive_threshold = adaptive_threshold
+        self.echo_context = echo_context
 
         self.ollama_client = ollama.AsyncClient()
+        self.generation_profiles = {
+            stage: {**profile, **(generation_profiles or {}).get(stage, {})}
+            for stage, profile in DEFAULT_GENERATION_PROFILES.items()
+        }
+        self.token_usage = {
+            stage: {'requests': 0, 'prompt_tokens': 0, 'eval_tokens': 0, 'eval_duration': 0}
+            for stage in DEFAULT_GENERATION_PROFILES
+        }
         
         # 添加缓存相关的属性
         self.cache_dir = Path(".translate_cache")
         self.cache_dir.mkdir(exist_ok=True)
-        self.cache_file = self.cache_dir / f"{self.input_file.stem}.cache"
+        # 指定目标语言时缓存按语言分开，避免多个语言的结果互相覆盖
+        cache_stem = f"{self.input_file.stem}.{target_language}" if target_language else self.input_file.stem
+        self.cache_file = self.cache_dir / f"{cache_stem}.cache"
+        # 限制内存模式下缓存存放在磁盘上的 shelve 数据库中，逐条写入，不整体加载也不整体重写
+        self.cache_db_file = self.cache_dir / f"{cache_stem}.cache-db"
         self.translation_cache = self._load_cache()
+        # 逐条字幕的翻译结果，按原文文本索引，用于增量翻译
+        self.block_map_file = self.cache_dir / f"{cache_stem}.blocks"
+        self.block_map = {}
+        # 质量评估结果缓存，按 (模型, 原文, 译文) 的哈希索引
+        self.quality_cache_file = self.cache_dir / f"{cache_stem}.quality"
+        self.quality_db_file = self.cache_dir / f"{cache_stem}.quality-db"
+        self.quality_cache = self._load_quality_cache()
+        # 各 (模型, 目标语言) 的历史评分分布 {"模型|语言": {评分: 次数}}，供 --adaptive-threshold 使用
+        self.score_history_file = self.cache_dir / "quality_scores.json"
+        self.score_history_key = f"{self.model_name}|{target_language or ''}"
+        self.new_scores = {}  # 本次运行中首次尝试的评分 {评分: 次数}，结束时写入历史
+        self.accept_threshold = self._compute_accept_threshold()
 
         self.prompt_template = """
 任务描述：
@@ -85,6 +177,11 @@ I'm fine, thank you!
 {content}
 
 """
+        if target_language:
+            self.prompt_template = self.prompt_template.replace(
+                "以下是字幕文件内容，请开始翻译：",
+                f"目标语言：{target_language}，请将所有字幕翻译为该语言。\n\n以下是字幕文件内容，请开始翻译："
+            )
         self.quality_check_prompt = """
 
 原文：
@@ -142,6 +239,8 @@ I'm fine, thank you!
 
     def _load_cache(self) -> dict:
         """加载翻译缓存"""
+        if self.max_in_flight is not None:
+            return shelve.open(str(self.cache_db_file))
         if self.cache_file.exists():
             try:
                 import json
@@ -152,7 +251,9 @@ I'm fine, thank you!
         return {}
 
     def _save_cache(self):
-        """保存翻译缓存"""
+        """保存翻译缓存；shelve 缓存在写入时已经落盘，无需保存"""
+        if self.max_in_flight is not None:
+            return
         try:
             import json
             self.cache_file.write_text(
@@ -162,6 +263,176 @@ I'm fine, thank you!
         except Exception as e:
             print(f"保存缓存失败: {e}")
 
+    def _load_quality_cache(self) -> dict:
+        """加载质量评估缓存"""
+        if self.max_in_flight is not None:
+            return shelve.open(str(self.quality_db_file))
+        if self.quality_cache_file.exists():
+            try:
+                import json
+                return json.loads(self.quality_cache_file.read_text(encoding='utf-8'))
+            except Exception as e:
+                print(f"加载质量评估缓存失败: {e}")
+                return {}
+        return {}
+
+    def _save_quality_cache(self):
+        """保存质量评估缓存；shelve 缓存在写入时已经落盘，无需保存"""
+        if self.max_in_flight is not None:
+            return
+        try:
+            import json
+            self.quality_cache_file.write_text(
+                json.dumps(self.quality_cache, ensure_ascii=False, indent=2),
+                encoding='utf-8'
+            )
+        except Exception as e:
+            print(f"保存质量评估缓存失败: {e}")
+
+    def _load_score_history(self) -> dict:
+        """加载所有 (模型, 目标语言) 的历史评分分布"""
+        if self.score_history_file.exists():
+            try:
+                import json
+                return json.loads(self.score_history_file.read_text(encoding='utf-8'))
+            except Exception as e:
+                print(f"加载历史评分失败: {e}")
+                return {}
+        return {}
+
+    def _save_score_history(self):
+        """把本次运行的评分并入历史评分分布；重新读取后再合并，避免覆盖其他语言同时写入的结果"""
+        if not self.new_scores:
+            return
+        try:
+            import json
+            history = self._load_score_history()
+            counts = history.setdefault(self.score_history_key, {})
+            for score, count in self.new_scores.items():
+                counts[score] = counts.get(score, 0) + count
+            self.score_history_file.write_text(json.dumps(history, ensure_ascii=False, indent=2), encoding='utf-8')
+            self.new_scores = {}
+        except Exception as e:
+            print(f"保存历史评分失败: {e}")
+
+    def _compute_accept_threshold(self) -> float:
+        """计算本次运行的质量评分通过阈值，运行期间不再改变
+
+        开启自适应阈值且当前模型在当前目标语言上已有足够多的历史评分时，若其 10% 分位数低于设定阈值，
+        说明该模型打分偏严，阈值随之下调，但最多下调 1 分，以减少临界分块的重试。
+        """
+        if not self.adaptive_threshold:
+            return self.quality_threshold
+        counts = self._load_score_history().get(self.score_history_key, {})
+        total = sum(counts.values())
+        if total < 20:
+            return self.quality_threshold
+        seen = 0
+        for score, count in sorted(counts.items(), key=lambda item: float(item[0])):
+            seen += count
+            if seen > total // 10:
+                low = float(score)
+                break
+        threshold = max(self.quality_threshold - 1.0, min(self.quality_threshold, low))
+        if threshold != self.quality_threshold:
+            print(f"{self.label}根据 {total} 个历史评分，通过阈值调整为 {threshold}")
+        return threshold
+
+    def _load_block_map(self) -> dict:
+        """加载上次翻译的逐条字幕结果"""
+        if self.block_map_file.exists():
+            try:
+                import json
+                return json.loads(self.block_map_file.read_text(encoding='utf-8'))
+            except Exception as e:
+                print(f"加载字幕映射失败: {e}")
+                return {}
+        return {}
+
+    def _save_block_map(self):
+        """保存本次翻译的逐条字幕结果"""
+        try:
+            import json
+            self.block_map_file.write_text(
+                json.dumps(self.block_map, ensure_ascii=False, indent=2),
+                encoding='utf-8'
+            )
+        except Exception as e:
+            print(f"保存字幕映射失败: {e}")
+
+    def _record_blocks(self, chunk: List[Tuple[str, str, str]], translated: List[Tuple[str, str, str]]):
+        """记录分块中每条原文对应的译文"""
+        for (_, _, source), (_, _, translation) in zip(chunk, translated):
+            self.block_map[self._get_cache_key(source)] = translation
+
+    def _plan_incremental(self, subtitles: List[Tuple[str, str, str]]) -> dict:
+        """对比上次的翻译结果，返回可以直接复用的译文 {序号: 译文}
+
+        只按原文文本匹配，因此仅调整了时间轴或序号的字幕也能复用；
+        文本有改动的字幕连同其前后相邻的字幕一起重新翻译。
+        """
+        previous = self._load_block_map()
+        keys = [self._get_cache_key(text) for _, _, text in subtitles]
+        hits = [key in previous for key in keys]
+        carried = {}
+        for i, (num, _, _) in enumerate(subtitles):
+            if hits[i] and (i == 0 or hits[i - 1]) and (i == len(subtitles) - 1 or hits[i + 1]):
+                carried[num] = previous[keys[i]]
+        print(f"增量翻译: 复用 {len(carried)} 条，重新翻译 {len(subtitles) - len(carried)} 条")
+        return carried
+
+    def _num_predict(self, stage: str, expected_text: str):
+        """返回阶段的最大生成 token 数；取值为 'auto' 时按预期输出的长度估算，并为思考过程留出余量"""
+        profile = self.generation_profiles[stage]
+        if profile.get('num_predict') != 'auto':
+            return profile.get('num_predict')
+        return estimate_tokens(expected_text) * 2 + 128 + THINK_TOKEN_ALLOWANCE[profile['think']]
+
+    async def _chat(self, stage: str, prompt: str, expected_text: str = ''):
+        """按阶段的生成参数调用模型，并累计该阶段的 token 用量
+
+        expected_text 为与预期输出长度相当的文本，num_predict 为 'auto' 时据此估算生成上限
+        """
+        profile = self.generation_profiles[stage]
+        options = {
+            key: profile[key]
+            for key in ('temperature', 'num_ctx')
+            if profile.get(key) is not None
+        }
+        num_predict = self._num_predict(stage, expected_text)
+        if num_predict is not None:
+            options['num_predict'] = num_predict
+        response = await self.ollama_client.chat(
+            model=self.model_name,
+            messages=[
+                {
+                    'role': 'user',
+                    'content': prompt,
+                },
+            ],
+            options=options,
+            stream=False,
+            think=profile['think'],
+            keep_alive=profile.get('keep_alive')
+        )
+
+        usage = self.token_usage[stage]
+        usage['requests'] += 1
+        usage['prompt_tokens'] += response.get('prompt_eval_count') or 0
+        usage['eval_tokens'] += response.get('eval_count') or 0
+        usage['eval_duration'] += response.get('eval_duration') or 0
+        return response
+
+    def report_token_usage(self):
+        """打印各阶段的 token 用量，用于调整生成参数"""
+        print(f"{self.label}Token 用量:")
+        for stage, usage in self.token_usage.items():
+            if not usage['requests']:
+                continue
+            speed = usage['eval_tokens'] / (usage['eval_duration'] / 1e9) if usage['eval_duration'] else 0.0
+            print(f"  {stage}: 请求 {usage['requests']} 次, 输入 {usage['prompt_tokens']} tokens, "
+                  f"生成 {usage['eval_tokens']} tokens (平均 {usage['eval_tokens'] / usage['requests']:.0f}/次, {speed:.1f} tokens/s)")
+
     def _get_cache_key(self, text: str) -> str:
         """生成缓存键"""
         import hashlib
@@ -184,20 +455,10 @@ I'm fine, thank you!
         for block in blocks:
             if not block.strip():
                 continue
-                
-            lines = block.strip().split('\n')
-            if len(lines) >= 3:
-                number = lines[0].strip()
-                timestamp = lines[1].strip()
-                text = '\n'.join(lines[2:]).strip()
-                
-                # 验证时间戳格式
-                if re.match(r'\d{2}:\d{2}:\d{2},\d{3}\s*-->\s*\d{2}:\d{2}:\d{2},\d{3}', timestamp):
-                    result.append((number, timestamp, text))
-                else:
-                    invalid_blocks.append(f"无效的时间戳格式: {block}")
-            else:
-                invalid_blocks.append(f"无效的字幕块: {block}")
+            try:
+                result.append(self._parse_block(block))
+            except ValueError as e:
+                invalid_blocks.append(str(e))
         
         if invalid_blocks:
             error_msg = "\n".join(invalid_blocks)
@@ -208,6 +469,35 @@ I'm fine, thank you!
             
         return result
 
+    def _parse_block(self, block: str) -> Tuple[str, str, str]:
+        """解析单个字幕块，返回 (序号, 时间戳, 文本内容)"""
+        lines = block.strip().split('\n')
+        if len(lines) < 3:
+            raise ValueError(f"无效的字幕块: {block}")
+
+        number = lines[0].strip()
+        timestamp = lines[1].strip()
+        text = '\n'.join(lines[2:]).strip()
+
+        # 验证时间戳格式
+        if not re.match(r'\d{2}:\d{2}:\d{2},\d{3}\s*-->\s*\d{2}:\d{2}:\d{2},\d{3}', timestamp):
+            raise ValueError(f"无效的时间戳格式: {block}")
+        return number, timestamp, text
+
+    def iter_subtitle_file(self, path: Path):
+        """逐块读取字幕文件，产出 (序号, 时间戳, 文本内容)，不把整个文件读入内存"""
+        lines = []
+        # utf-8-sig 会去除 BOM 标记，通用换行模式会统一换行符
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                if line.strip():
+                    lines.append(line.rstrip('\n'))
+                elif lines:
+                    yield self._parse_block('\n'.join(lines))
+                    lines = []
+        if lines:
+            yield self._parse_block('\n'.join(lines))
+
     def validate_format(self, translated_text: str) -> bool:
         """验证翻译后的文本是否符合字幕格式"""
         try:
@@ -227,8 +517,17 @@ I'm fine, thank you!
             logging.warning(f"翻译返回内容:\n{translated_text}")
             return False
 
-    async def check_translation_quality(self, source_text: str, translated_text: str) -> Tuple[float, str]:
-        """使用 LLM 评估翻译质量并获取修改建议"""
+    async def check_translation_quality(self, source_text: str, translated_text: str, record_score: bool = False) -> Tuple[float, str]:
+        """使用 LLM 评估翻译质量并获取修改建议
+
+        record_score 为 True 时把评分计入历史评分分布（只记录首次尝试的评分，重试的评分偏低，会使分布失真）
+        """
+        quality_key = self._get_cache_key(f"{self.model_name}\n\n{source_text}\n\n{translated_text}")
+        if quality_key in self.quality_cache:
+            cached = self.quality_cache[quality_key]
+            print(f"使用缓存的质量评估得分: {cached['score']}/10")
+            return cached['score'], cached['suggestion']
+
         try:
             print(f"正在进行翻译质量评估...")
             
@@ -251,21 +550,7 @@ I'm fine, thank you!
             # )
 
             try:
-                stdout = await self.ollama_client.chat(
-                    model=self.model_name,
-                    messages=[
-                        {
-                            'role': 'user',
-                            'content': prompt,
-                        },
-                    ],
-                    options={
-                        'temperature': 1.3,
-                        'num_predict': 8192,
-                    },
-                    stream=False,
-                    think=True
-                )
+                stdout = await self._chat('quality_check', prompt, translated_text)
             except Exception as e:
                 print("质量评估失败!")
                 raise Exception(f"质量评估命令执行失败: {e}")
@@ -287,16 +572,29 @@ I'm fine, thank you!
             score = 0.0
             suggestion = ""
             
+            scored = False
             if score_match:
                 try:
                     score = float(score_match.group(1))
+                    scored = True
                 except ValueError:
                     print(f"无法解析评分结果: {score_match.group(1)}")
             
             if suggestion_match:
                 suggestion = suggestion_match.group(1).strip()
+
+            # 只缓存成功解析出评分的结果
+            if scored:
+                self.quality_cache[quality_key] = {
+                    'model': self.model_name,
+                    'score': score,
+                    'suggestion': suggestion,
+                }
+                self._save_quality_cache()
+                if record_score:
+                    self.new_scores[str(score)] = self.new_scores.get(str(score), 0) + 1
             
-            print(f"质量评估得分: {score}/10 {'✓' if score >= 5.0 else '✗'}")
+            print(f"质量评估得分: {score}/10 {'✓' if score >= self.accept_threshold else '✗'}")
             if score < 8.0 and suggestion:
                 print("修改建议:")
                 print(suggestion)
@@ -333,332 +631,830 @@ I'm fine, thank you!
             processed.append((num, timestamp, processed_text))
         return processed
 
-    async def translate_chunk(self, chunk: List[Tuple[str, str, str]], all_subtitles: List[Tuple[str, str, str]], depth: int = 0) -> str:
-        """翻译一个字幕块，包含上下文"""
+    def _format_subtitles(self, subtitles: List[Tuple[str, str, str]]) -> str:
+        """把 (序号, 时间戳, 文本内容) 拼接成 SRT 文本"""
+        return '\n\n'.join(f'{num}\n{timestamp}\n{text}' for num, timestamp, text in subtitles)
+
+    def _format_reference(self, before: List[Tuple[str, str, str]], after: List[Tuple[str, str, str]], use_accepted: bool) -> str:
+        """生成参考上下文文本；use_accepted 时前文优先使用已接受的译文，并标明哪些是译文、哪些是原文"""
+        if not before and not after:
+            return ''
+        lines = []
+        label = None
+        for num, _, text in before:
+            accepted = self.accepted_lines.get(num) if use_accepted else None
+            # 标明每段前文是已接受的译文还是原文，连续的同类字幕共用一个标题
+            current = '前文（译文）：' if accepted is not None else '前文（原文）：'
+            if current != label:
+                lines.append(current)
+                label = current
+            lines.append(accepted if accepted is not None else text)
+        if after:
+            lines.append('后文（原文）：')
+            lines.extend(text for _, _, text in after)
+        return '\n'.join(lines)
+
+    def _build_prompt(self, subtitle_text: str, reference: str) -> str:
+        """生成翻译提示，参考上下文放在待翻译内容之前"""
+        prompt = self.prompt_template.format(content=subtitle_text)
+        if not reference:
+            return prompt
+        marker = "以下是字幕文件内容，请开始翻译："
+        head, tail = prompt.split(marker, 1)
+        return f"""{head}参考上下文（仅用于理解语境，不要翻译，也不要在输出中包含）：
+{reference}
+
+{marker}{tail}"""
+
+    def _should_split(self, chunk: List[Tuple[str, str, str]], attempt: int) -> bool:
+        """是否在本次重试时把分块拆成两半分别翻译"""
+        return attempt > 0 and attempt % self.split_retry == 0 and len(chunk) > 1
+
+    def _split_chunk(self, chunk: List[Tuple[str, str, str]]):
+        """把分块拆成前后两半"""
+        mid = len(chunk) // 2
+        return chunk[:mid], chunk[mid:]
+
+    def _merge_halves(self, chunk: List[Tuple[str, str, str]], first_half: List[Tuple[str, str, str]], second_half: List[Tuple[str, str, str]], first_result: List[Tuple[str, str, str]], second_result: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+        """合并拆分后两部分的翻译结果，并验证数量和序号，不符合时抛出异常"""
+        print("合并前检查:")
+        print(f"第一部分字幕块数: {len(first_result)}")
+        print(f"第二部分字幕块数: {len(second_result)}")
+
+        # 根据原始chunk的序号筛选需要的字幕块，只保留各自部分的核心内容
+        first_nums = {num for num, _, _ in first_half}
+        second_nums = {num for num, _, _ in second_half}
+        filtered_first = [subtitle for subtitle in first_result if subtitle[0] in first_nums]
+        filtered_second = [subtitle for subtitle in second_result if subtitle[0] in second_nums]
+
+        print(f"过滤后第一部分字幕块数: {len(filtered_first)}")
+        print(f"过滤后第二部分字幕块数: {len(filtered_second)}")
+
+        merged_subtitles = filtered_first + filtered_second
+        try:
+            print(f"合并后总字幕数: {len(merged_subtitles)}, 期望数量: {len(chunk)}")
+
+            if len(merged_subtitles) != len(chunk):
+                print("字幕数量不匹配，显示合并结果的前后几行:")
+                lines = self._format_subtitles(merged_subtitles).split('\n')
+                print("前5行:")
+                print('\n'.join(lines[:5]))
+                print("后5行:")
+                print('\n'.join(lines[-5:]))
+                raise ValueError(f"合并结果验证失败: 期望 {len(chunk)} 条字幕，实际得到 {len(merged_subtitles)} 条")
+            
+            # 验证序号的连续性
+            for i, (num, _, _) in enumerate(merged_subtitles):
+                expected_num = str(int(chunk[i][0]))
+                if num != expected_num:
+                    raise ValueError(f"序号不匹配: 期望 {expected_num}，实际得到 {num}")
+                    
+        except Exception as e:
+            logging.error(f"合并结果验证失败: {str(e)}")
+            raise
+        
+        return merged_subtitles
+
+    async def _translate_attempt(self, chunk: List[Tuple[str, str, str]], all_subtitles: List[Tuple[str, str, str]], attempt: int, last_suggestion: str = "") -> Tuple[List[Tuple[str, str, str]], str]:
+        """对分块进行一次翻译尝试（不拆分），返回 (译文字幕, 修改建议)，失败时译文字幕为 None
+
+        译文字幕为 (序号, 时间戳, 文本内容) 列表，已经过标点处理，之后不需要再解析；
+
+        第 attempt 次尝试使用 context_size + attempt 条上下文；
+        all_subtitles 只需覆盖该块前后 context_size + max_retries - 1 条字幕即可，不必是完整的字幕列表
+        """
         start_num = chunk[0][0]
         end_num = chunk[-1][0]
-        print(f"开始翻译字幕块 {start_num}-{end_num} (深度: {depth})")
-
         chunk_start_idx = next(i for i, (num, _, _) in enumerate(all_subtitles) if num == start_num)
+        current_context_size = self.context_size + attempt
+        print(f"尝试使用上下文大小: {current_context_size}")
+
+        # 构建包含上下文的字幕块
+        context_start = max(0, chunk_start_idx - current_context_size)
+        context_end = min(len(all_subtitles), chunk_start_idx + len(chunk) + current_context_size)
+        context_chunk = all_subtitles[context_start:context_end]
+        if self.echo_context:
+            # 上下文与分块一起翻译，结果中再切掉上下文部分
+            prompt_subtitles = context_chunk
+            context_prefix_size = chunk_start_idx - context_start
+            context_suffix_size = context_end - chunk_start_idx - len(chunk)
+            reference = source_reference = ''
+        else:
+            # 上下文只作为参考，模型只需翻译并输出分块本身
+            prompt_subtitles = chunk
+            context_prefix_size = context_suffix_size = 0
+            before = all_subtitles[context_start:chunk_start_idx]
+            after = all_subtitles[chunk_start_idx + len(chunk):context_end]
+            reference = self._format_reference(before, after, use_accepted=True)
+            source_reference = self._format_reference(before, after, use_accepted=False)
         
-        max_retries = 10
-        last_suggestion = ""
+        # 生成字幕文本
+        subtitle_text = '\n\n'.join(
+            f'{num}\n{timestamp}\n{text}' 
+            for num, timestamp, text in prompt_subtitles
+        )
         
-        for attempt in range(max_retries):
-            current_context_size = self.context_size + attempt
-            print(f"尝试使用上下文大小: {current_context_size}")
+        # 检查缓存：参考上下文按原文计入缓存键，无论前文译文是否已就绪都能命中
+        cache_key = self._get_cache_key(source_reference + subtitle_text)
+        if cache_key in self.translation_cache:
+            print(f"使用缓存的翻译结果 {start_num}-{end_num}")
+            cached_text = self.translation_cache[cache_key]
             
-            # 检查是否需要拆分任务
-            if attempt > 0 and attempt % self.split_retry == 0 and len(chunk) > 1:
-                print(f"第 {attempt} 次重试，拆分任务...")
-                mid = len(chunk) // 2
-                first_half = chunk[:mid]
-                second_half = chunk[mid:]
-                
-                try:
-                    print(f"处理第一部分: {first_half[0][0]}-{first_half[-1][0]} ({len(first_half)}条)")
-                    first_result = await self.translate_chunk(first_half, all_subtitles, depth + 1)
-                    first_subtitles = self.parse_subtitle(first_result)
-                    print(f"第一部分翻译完成，返回 {len(first_subtitles)} 条字幕")
-                    
-                    print(f"处理第二部分: {second_half[0][0]}-{second_half[-1][0]} ({len(second_half)}条)")
-                    second_result = await self.translate_chunk(second_half, all_subtitles, depth + 1)
-                    second_subtitles = self.parse_subtitle(second_result)
-                    print(f"第二部分翻译完成，返回 {len(second_subtitles)} 条字幕")
-                    
-                    # 合并结果时，只保留各自部分的核心内容
-                    if first_result and second_result:
-                        # 获取第一部分的字幕
-                        first_blocks = first_result.rstrip().split('\n\n')
-                        # 获取第二部分的字幕
-                        second_blocks = second_result.lstrip().split('\n\n')
-                        
-                        print("合并前检查:")
-                        print(f"第一部分字幕块数: {len(first_blocks)}")
-                        print(f"第二部分字幕块数: {len(second_blocks)}")
-                        
-                        # 根据原始chunk的序号筛选需要的字幕块
-                        first_nums = {num for num, _, _ in first_half}
-                        second_nums = {num for num, _, _ in second_half}
-                        
-                        # 只保留属于当前部分的字幕块
-                        filtered_first = []
-                        filtered_second = []
-                        
-                        for block in first_blocks:
-                            lines = block.split('\n')
-                            if len(lines) >= 1 and lines[0].strip() in first_nums:
-                                filtered_first.append(block)
-                            
-                        for block in second_blocks:
-                            lines = block.split('\n')
-                            if len(lines) >= 1 and lines[0].strip() in second_nums:
-                                filtered_second.append(block)
-                        
-                        print(f"过滤后第一部分字幕块数: {len(filtered_first)}")
-                        print(f"过滤后第二部分字幕块数: {len(filtered_second)}")
-                        
-                        # 合并过滤后的结果
-                        combined_result = '\n\n'.join(filtered_first + filtered_second)
-                    else:
-                        combined_result = first_result or second_result
-                    
-                    # 验证合并后的结果
-                    try:
-                        merged_subtitles = self.parse_subtitle(combined_result)
-                        print(f"合并后总字幕数: {len(merged_subtitles)}, 期望数量: {len(chunk)}")
-                        
-                        if len(merged_subtitles) != len(chunk):
-                            print("字幕数量不匹配，显示合并结果的前后几行:")
-                            lines = combined_result.split('\n')
-                            print("前5行:")
-                            print('\n'.join(lines[:5]))
-                            print("后5行:")
-                            print('\n'.join(lines[-5:]))
-                            raise ValueError(f"合并结果验证失败: 期望 {len(chunk)} 条字幕，实际得到 {len(merged_subtitles)} 条")
-                        
-                        # 验证序号的连续性
-                        for i, (num, _, _) in enumerate(merged_subtitles):
-                            expected_num = str(int(chunk[i][0]))
-                            if num != expected_num:
-                                raise ValueError(f"序号不匹配: 期望 {expected_num}，实际得到 {num}")
-                                
-                    except Exception as e:
-                        logging.error(f"合并结果验证失败: {str(e)}")
-                        raise
-                    
-                    return combined_result
-                    
-                except Exception as e:
-                    logging.error(f"拆分任务处理失败: {str(e)}")
-                    # 打印更多错误信息
-                    import traceback
-                    logging.error(traceback.format_exc())
-                    continue
-            
-            # 构建包含上下文的字幕块
-            context_start = max(0, chunk_start_idx - current_context_size)
-            context_end = min(len(all_subtitles), chunk_start_idx + len(chunk) + current_context_size)
-            context_chunk = all_subtitles[context_start:context_end]
-            
-            # 生成带上下文的字幕文本
-            subtitle_text = '\n\n'.join(
-                f'{num}\n{timestamp}\n{text}' 
-                for num, timestamp, text in context_chunk
-            )
-            
-            # 检查缓存
-            cache_key = self._get_cache_key(subtitle_text)
-            if cache_key in self.translation_cache:
-                print(f"使用缓存的翻译结果 {start_num}-{end_num}")
-                cached_text = self.translation_cache[cache_key]
-                
-                try:
-                    cached_subtitles = self.parse_subtitle(cached_text)
-                    # 对缓存的结果也应用标点处理
-                    processed_subtitles = self._process_subtitle_blocks(cached_subtitles)
-                    
-                    context_prefix_size = min(current_context_size, chunk_start_idx)
-                    if len(context_chunk) > len(chunk):
-                        result_subtitles = processed_subtitles[context_prefix_size:len(processed_subtitles)-min(current_context_size, len(all_subtitles)-context_end+1)]
-                    else:
-                        result_subtitles = processed_subtitles
-                        
-                    result_text = '\n\n'.join(
-                        f'{num}\n{timestamp}\n{text}' 
-                        for num, timestamp, text in result_subtitles
-                    )
-                    return result_text
-                except Exception as e:
-                    logging.warning(f"处理缓存结果失败: {str(e)}")
-                    del self.translation_cache[cache_key]
-                    self._save_cache()
-
             try:
-                # 在提示模板中加入上一次的修改建议
-                full_prompt = self.prompt_template.format(content=subtitle_text)
-                if last_suggestion:
-                    full_prompt = f"""
-{self.prompt_template.format(content=subtitle_text)}
+                cached_subtitles = self.parse_subtitle(cached_text)
+                # 对缓存的结果也应用标点处理
+                processed_subtitles = self._process_subtitle_blocks(cached_subtitles)
+                result_subtitles = processed_subtitles[context_prefix_size:len(processed_subtitles)-context_suffix_size]
+                return result_subtitles, last_suggestion
+            except Exception as e:
+                logging.warning(f"处理缓存结果失败: {str(e)}")
+                del self.translation_cache[cache_key]
+                self._save_cache()
+
+        try:
+            # 在提示模板中加入上一次的修改建议
+            full_prompt = self._build_prompt(subtitle_text, reference)
+            if last_suggestion:
+                full_prompt = f"""
+{self._build_prompt(subtitle_text, reference)}
 
 参考以下修改建议进行优化：
 {last_suggestion}
 """
-                
-                # process = await asyncio.create_subprocess_exec(
-                #     'guru',
-                #     '--renderer', 'text',
-                #     '-n',
-                #     '--chatgpt.stream=false',
-                #     '--chatgpt.temperature=1.3',
-                #     '--chatgpt.max_tokens=8192',
-                #     full_prompt,
-                #     stdin=asyncio.subprocess.PIPE,
-                #     stdout=asyncio.subprocess.PIPE,
-                #     stderr=asyncio.subprocess.PIPE
-                # )
+            
+            # process = await asyncio.create_subprocess_exec(
+            #     'guru',
+            #     '--renderer', 'text',
+            #     '-n',
+            #     '--chatgpt.stream=false',
+            #     '--chatgpt.temperature=1.3',
+            #     '--chatgpt.max_tokens=8192',
+            #     full_prompt,
+            #     stdin=asyncio.subprocess.PIPE,
+            #     stdout=asyncio.subprocess.PIPE,
+            #     stderr=asyncio.subprocess.PIPE
+            # )
 
-                try:
-                    stdout = await self.ollama_client.chat(
-                        model=self.model_name,
-                        messages=[
-                            {
-                                'role': 'user',
-                                'content': full_prompt,
-                            },
-                        ],
-                        options={
-                            'temperature': 1.3,
-                            'num_predict': 8192,
-                        },
-                        stream=False,
-                        think=True
-                    )
-                except Exception as e:
-                    raise Exception(f"翻译命令执行失败: {e}")
-                
-                # stdout, stderr = await process.communicate(subtitle_text.encode('utf-8'))
-                
-                # if process.returncode != 0:
-                #     raise Exception(f"翻译命令执行失败: {stderr.decode('utf-8')}")
+            try:
+                stdout = await self._chat('translate', full_prompt, subtitle_text)
+            except Exception as e:
+                raise Exception(f"翻译命令执行失败: {e}")
+            
+            # stdout, stderr = await process.communicate(subtitle_text.encode('utf-8'))
+            
+            # if process.returncode != 0:
+            #     raise Exception(f"翻译命令执行失败: {stderr.decode('utf-8')}")
+            
+            # 处理翻译返回的文本，去除每行末尾的空白字符
+            # translated_text = stdout.decode('utf-8')
+            translated_text = stdout['message']['content']
+            translated_text = '\n'.join(line.rstrip() for line in translated_text.splitlines())
+            
+            # 验证翻译结果格式
+            if not self.validate_format(translated_text):
+                logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的结果格式无效")
+                return None, last_suggestion
                 
-                # 处理翻译返回的文本，去除每行末尾的空白字符
-                # translated_text = stdout.decode('utf-8')
-                translated_text = stdout['message']['content']
-                translated_text = '\n'.join(line.rstrip() for line in translated_text.splitlines())
+            # 验证翻译结果的字幕数量是否匹配
+            translated_subtitles = self.parse_subtitle(translated_text)
+            expected_size = len(prompt_subtitles)
+            if len(translated_subtitles) != expected_size:
+                logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的字幕数量不匹配 (上下文大小: {current_context_size})")
+                logging.warning(f"期望数量: {expected_size}, 实际数量: {len(translated_subtitles)}")
+                return None, last_suggestion
                 
-                # 验证翻译结果格式
-                if not self.validate_format(translated_text):
-                    logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的结果格式无效")
-                    continue
-                    
-                # 验证翻译结果的字幕数量是否匹配
-                translated_subtitles = self.parse_subtitle(translated_text)
-                expected_size = len(context_chunk)
-                if len(translated_subtitles) != expected_size:
-                    logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的字幕数量不匹配 (上下文大小: {current_context_size})")
-                    logging.warning(f"期望数量: {expected_size}, 实际数量: {len(translated_subtitles)}")
+            # 验证序号和时间戳是否保持一致
+            for (orig_num, orig_ts, _), (trans_num, trans_ts, _) in zip(prompt_subtitles, translated_subtitles):
+                if orig_num != trans_num or orig_ts != trans_ts:
+                    logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的序号或时间戳不匹配")
                     continue
-                    
-                # 验证序号和时间戳是否保持一致
-                for (orig_num, orig_ts, _), (trans_num, trans_ts, _) in zip(context_chunk, translated_subtitles):
-                    if orig_num != trans_num or orig_ts != trans_ts:
-                        logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的序号或时间戳不匹配")
-                        continue
-                    
-                # 在其他验证都通过后，进行质量评估
-                # 注意：质量评估应该只针对核心内容，不包括上下文
-                context_prefix_size = min(current_context_size, chunk_start_idx)
-                context_suffix_size = min(current_context_size, len(all_subtitles)-context_end+1)
-                core_translated_subtitles = translated_subtitles[context_prefix_size:len(translated_subtitles)-context_suffix_size]
-                
-                source_content = '\n'.join(text for _, _, text in chunk)
-                translated_content = '\n'.join(text for _, _, text in core_translated_subtitles)
                 
-                # 质量评估时获取修改建议
-                quality_score, suggestion = await self.check_translation_quality(source_content, translated_content)
-                if quality_score < 5.0:
-                    logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的质量评分过低: {quality_score}")
-                    last_suggestion = suggestion  # 保存这次的修改建议
-                    continue
+            # 在其他验证都通过后，进行质量评估
+            # 注意：质量评估应该只针对核心内容，不包括上下文
+            core_translated_subtitles = translated_subtitles[context_prefix_size:len(translated_subtitles)-context_suffix_size]
+            
+            source_content = '\n'.join(text for _, _, text in chunk)
+            translated_content = '\n'.join(text for _, _, text in core_translated_subtitles)
+            
+            # 质量评估时获取修改建议
+            quality_score, suggestion = await self.check_translation_quality(source_content, translated_content, record_score=attempt == 0)
+            threshold = self.accept_threshold
+            if quality_score < threshold:
+                logging.warning(f"翻译块 {start_num}-{end_num} 第 {attempt + 1} 次尝试的质量评分过低: {quality_score}")
+                return None, suggestion
+            
+            # 在质量评估通过后，处理标点并保存到缓存
+            if quality_score >= threshold:
+                processed_subtitles = self._process_subtitle_blocks(translated_subtitles)
                 
-                # 在质量评估通过后，处理标点并保存到缓存
-                if quality_score >= 5.0:
-                    processed_subtitles = self._process_subtitle_blocks(translated_subtitles)
-                    
-                    # 重新生成处理后的文本
-                    processed_text = '\n\n'.join(
-                        f'{num}\n{timestamp}\n{text}' 
-                        for num, timestamp, text in processed_subtitles
-                    )
-                    
-                    # 保存原始翻译结果到缓存（不保存处理后的结果）
-                    if translated_text:
-                        self.translation_cache[cache_key] = translated_text
-                        self._save_cache()
-                    
-                    # 从处理后的结果中提取原始块对应的部分
-                    result_subtitles = processed_subtitles  # 直接使用处理后的字幕
-                    # 根据上下文大小调整切片范围
-                    context_prefix_size = min(current_context_size, chunk_start_idx)
-                    if len(context_chunk) > len(chunk):
-                        result_subtitles = result_subtitles[context_prefix_size:len(result_subtitles)-min(current_context_size, len(all_subtitles)-context_end+1)]
-                    
-                    result_text = '\n\n'.join(
-                        f'{num}\n{timestamp}\n{text}' 
-                        for num, timestamp, text in result_subtitles
-                    )
-                    
-                    print(f"完成翻译字幕块 {start_num}-{end_num} (质量评分: {quality_score})")
-                    return result_text
+                # 保存原始翻译结果到缓存（不保存处理后的结果）
+                if translated_text:
+                    self.translation_cache[cache_key] = translated_text
+                    self._save_cache()
                 
-            except Exception as e:
-                logging.error(f"翻译块 {start_num}-{end_num} 出错 (上下文大小: {current_context_size}): {str(e)}")
-                continue
+                # 从处理后的结果中提取原始块对应的部分
+                result_subtitles = processed_subtitles[context_prefix_size:len(processed_subtitles)-context_suffix_size]
                 
-        logging.error(f"翻译块 {start_num}-{end_num} 失败，已尝试上下文大小范围: {self.context_size}-{self.context_size+max_retries-1}")
-        raise Exception(f"翻译块 {start_num}-{end_num} 失败，超过最大重试次数")
+                print(f"完成翻译字幕块 {start_num}-{end_num} (质量评分: {quality_score})")
+                return result_subtitles, last_suggestion
+            
+        except Exception as e:
+            logging.error(f"翻译块 {start_num}-{end_num} 出错 (上下文大小: {current_context_size}): {str(e)}")
+            return None, last_suggestion
 
-    async def translate(self):
-        """主翻译流程"""
+    def _iter_chunks(self, subtitles, carried: dict = None):
+        """按分块大小切分字幕流，产出 (分块, 上下文窗口, 复用的译文)
+
+        每个分块要等到其后的上下文也已到达（或字幕流结束）才会产出，
+        窗口只保留后续分块仍可能用到的上下文，不需要事先拿到完整的字幕列表。
+        carried 中的字幕不再翻译，连续的一段直接以复用的译文产出（此时上下文窗口为 None）。
+        """
+        carried = carried or {}
+        margin = self.context_size + self.max_retries - 1
+        subtitles = iter(subtitles)
+        exhausted = False
+        window = []
+        pos = 0  # 下一个分块在 window 中的起始位置
+
+        while True:
+            # 读入足够的字幕，保证下一个分块及其后文上下文已经到达
+            while not exhausted and len(window) - pos < self.chunk_size + margin:
+                try:
+                    window.append(next(subtitles))
+                except StopIteration:
+                    exhausted = True
+            if pos >= len(window):
+                return
+
+            # 分块内的字幕要么全部复用，要么全部翻译
+            reuse = window[pos][0] in carried
+            end = pos + 1
+            while end < min(len(window), pos + self.chunk_size) and (window[end][0] in carried) == reuse:
+                end += 1
+
+            chunk = window[pos:end]
+            if reuse:
+                yield chunk, None, [(num, timestamp, carried[num]) for num, timestamp, _ in chunk]
+            else:
+                yield chunk, window[max(0, pos - margin):end + margin], None
+            pos = end
+
+            # 丢弃之后的分块不再需要的上下文
+            drop = max(0, pos - margin)
+            del window[:drop]
+            pos -= drop
+
+    def _timestamp_to_ms(self, timestamp: str) -> int:
+        """把时间戳的起始时间转换为毫秒"""
+        h, m, rest = timestamp.split('-->')[0].strip().split(':')
+        sec, ms = rest.split(',')
+        return ((int(h) * 60 + int(m)) * 60 + int(sec)) * 1000 + int(ms)
+
+    def _open_output(self, in_flight: asyncio.Semaphore = None):
+        """开始按顺序写入输出文件"""
+        self._finished = {}  # 已完成但前面还有分块未完成、暂不能写入的结果
+        self._next_index = 0
+        self._in_flight = in_flight
+        self.block_map = {} if self.max_in_flight is None else None
+        self._output = self.output_file.open('w', encoding='utf-8')
+
+    def _write_ready(self, index: int, chunk: List[Tuple[str, str, str]], result: List[Tuple[str, str, str]]):
+        """保存分块结果（(序号, 时间戳, 译文) 列表），并把已经连续完成的前缀写入输出文件"""
+        if self.block_map is not None:
+            self._record_blocks(chunk, result)
+        for (num, _, _), (_, _, text) in zip(chunk, result):
+            self.accepted_lines[num] = text
+        if self.max_in_flight is not None:
+            # 限制内存模式下只保留最近的译文，足够后续分块作为参考上下文
+            limit = (self.max_in_flight + 2) * self.chunk_size
+            for num in list(self.accepted_lines)[:max(0, len(self.accepted_lines) - limit)]:
+                del self.accepted_lines[num]
+        self._finished[index] = (chunk, result)
+        if self._next_index not in self._finished:
+            return
+        while self._next_index in self._finished:
+            chunk, result = self._finished.pop(self._next_index)
+            self._output.write(('\n\n' if self._next_index else '') + self._format_subtitles(result))
+            self._next_index += 1
+            if self._in_flight is not None:
+                self._in_flight.release()
+        self._output.flush()
+        print(f"{self.label}已写入至第 {chunk[-1][0]} 条字幕，可预览至 {chunk[-1][1].split('-->')[1].strip()}")
+
+    def _close_output(self, completed: bool):
+        """结束输出；全部完成时补上结尾换行并保存逐条字幕映射"""
+        if completed:
+            self._output.write('\n')
+        self._output.close()
+        self._save_score_history()
+        if self.max_in_flight is not None:
+            self.translation_cache.close()
+            self.quality_cache.close()
+        if not completed:
+            return
+        print(f"{self.label}翻译完成")
+        if self.block_map is not None:
+            self._save_block_map()
+        print(f"{self.label}已保存到: {self.output_file}")
+        self.report_token_usage()
+
+    def _pivot_source(self, chunk: List[Tuple[str, str, str]], window: List[Tuple[str, str, str]]):
+        """中转模式：如果中转语言已经接受了该分块的译文且估算的 token 数更少，就以其作为翻译原文
+
+        上下文窗口只保留与分块相连、且都有中转译文的字幕，避免提示词中混杂两种语言的原文。
+        """
+        if self.pivot is None:
+            return chunk, window
+        pivot_lines = self.pivot.accepted_lines
+        if any(num not in pivot_lines for num, _, _ in chunk):
+            return chunk, window
+        pivot_cost = sum(estimate_tokens(pivot_lines[num]) for num, _, _ in chunk)
+        if pivot_cost >= sum(estimate_tokens(text) for _, _, text in chunk):
+            return chunk, window
+        print(f"{self.label}使用 {self.pivot.target_language} 译文作为字幕块 {chunk[0][0]}-{chunk[-1][0]} 的原文")
+        start = next(i for i, (num, _, _) in enumerate(window) if num == chunk[0][0])
+        end = start + len(chunk)
+        while start > 0 and window[start - 1][0] in pivot_lines:
+            start -= 1
+        while end < len(window) and window[end][0] in pivot_lines:
+            end += 1
+        chunk = [(num, timestamp, pivot_lines[num]) for num, timestamp, _ in chunk]
+        window = [(num, timestamp, pivot_lines[num]) for num, timestamp, _ in window[start:end]]
+        return chunk, window
+
+    def _read_input(self):
+        """读取输入字幕，返回 (字幕序列, 字幕总数)；限制内存模式下逐块读取，总数未知"""
+        if self.max_in_flight is not None:
+            return self.iter_subtitle_file(self.input_file), None
         content = self.input_file.read_text(encoding='utf-8')
         subtitles = self.parse_subtitle(content)
-        total_chunks = len(subtitles) // self.chunk_size + (1 if len(subtitles) % self.chunk_size else 0)
         print(f"总字幕数: {len(subtitles)}")
-        print(f"分块大小: {self.chunk_size}")
+        return subtitles, len(subtitles)
+
+    async def translate_stream(self, subtitles, total: int = None, carried: dict = None):
+        """流式翻译：逐条接收字幕，凑满一个分块即开始翻译，不必等待全部字幕就绪"""
+        await run_translation([self], subtitles, total=total, carried=carried)
+
+    async def translate(self):
+        """主翻译流程"""
+        subtitles, total = self._read_input()
+        if self.incremental:
+            carried = self._plan_incremental(subtitles)
+            await self.translate_stream(subtitles, carried=carried)
+        else:
+            await self.translate_stream(subtitles, total=total)
+
+class ChunkJob:
+    """调度队列中的一个翻译任务：一个分块（或拆分出的半块）及其重试状态
+
+    每次尝试结束后任务以原来的优先级放回队列，拆分出的两半也继承父任务的优先级，
+    因此靠前分块的重试总是排在靠后分块的首次尝试之前。
+    """
+    def __init__(self, translator, index, chunk, window, priority, depth=0, parent=None):
+        self.translator = translator
+        self.index = index  # 在输出中的分块序号，拆分出的半块沿用父任务的序号
+        self.chunk = chunk
+        self.output_chunk = chunk  # 写入输出时使用的原文分块（中转模式下 chunk 会换成中转语言的译文）
+        self.window = window
+        self.priority = priority
+        self.depth = depth
+        self.parent = parent  # (父任务, 第几半)
+        self.attempt = 0
+        self.last_suggestion = ""
+        self.halves = None  # 拆分后两半的结果
+        self.children = []
+        self.cancelled = False
+
+class ChunkQueue:
+    """按优先级调度翻译任务的队列，接口与 asyncio.PriorityQueue 相同
+
+    get 时在优先级最高的 lookahead 个任务中挑选 tier(job) 最小者（相同时取优先级高者），
+    不会因为没有理想的任务而等待；lookahead 限制了任务被推迟的程度。
+    """
+    def __init__(self, tier, lookahead):
+        self.tier = tier
+        self.lookahead = lookahead
+        self.heap = []
+        self.sequence = 0
+        self.available = asyncio.Semaphore(0)
+        self.unfinished = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def put_nowait(self, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.priority, self.sequence, job))
+        self.unfinished += 1
+        self.idle.clear()
+        self.available.release()
+
+    async def get(self):
+        await self.available.acquire()
+        candidates = [heapq.heappop(self.heap) for _ in range(min(self.lookahead, len(self.heap)))]
+        best = min(range(len(candidates)), key=lambda i: (self.tier(candidates[i][2]), i))
+        for i, entry in enumerate(candidates):
+            if i != best:
+                heapq.heappush(self.heap, entry)
+        return candidates[best][2]
+
+    def task_done(self):
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.idle.set()
+
+    async def join(self):
+        await self.idle.wait()
+
+async def run_translation(translators: List[SubtitleTranslator], subtitles, total: int = None, carried: dict = None):
+    """按顺序把字幕流切分成分块，分派给一个或多个目标语言的翻译器
+
+    所有目标语言共用第一个翻译器的分块设置和并发额度，只解析、分块一次。
+    调度按截止时间优先：分块的截止时间就是它在视频中的起始时间（从头观看时最晚需要它的时刻），
+    同一位置按翻译器顺序。每次重试和拆分出的两半都作为单独的任务以原优先级放回队列，
+    不会一直占用并发名额，靠前分块的重试也不会排在靠后分块之后。
+    使用参考上下文时，在靠前的若干任务中优先选择前一分块已被接受的任务，其次是前一分块尚未开始的任务，
+    使大部分分块能以前一分块已接受的译文作为参考（例如开始时先翻译偶数分块，奇数分块随后参考其译文）。
+    已完成的连续前缀立即按顺序写入各自的输出文件，便于边翻译边预览。
+    设置了 max_in_flight 时，最多只有这么多分块处于已分派但尚未写入的状态，
+    此时不再记录逐条字幕映射，内存占用与字幕总数无关。
+    carried 为增量翻译时可复用的译文，仅支持单个翻译器。
+    """
+    lead = translators[0]
+    print(f"分块大小: {lead.chunk_size}")
+    if total is not None:
+        total_chunks = (total // lead.chunk_size + (1 if total % lead.chunk_size else 0)) * len(translators)
         print(f"总任务数: {total_chunks}")
-        
-        # 分块
-        chunks = [subtitles[i:i + self.chunk_size] 
-                 for i in range(0, len(subtitles), self.chunk_size)]
-        
-        results = []
-        completed = 0
-        semaphore = asyncio.Semaphore(self.max_concurrent)
-        
-        async def translate_with_semaphore(chunk, chunk_index):
-            nonlocal completed
-            async with semaphore:
-                # 传入完整的字幕列表，用于获取上下文
-                result = await self.translate_chunk(chunk, subtitles)
-                completed += 1
-                print(f"进度: {completed}/{total_chunks} ({completed/total_chunks*100:.1f}%)")
-                return result
-        
-        tasks = [translate_with_semaphore(chunk, i) for i, chunk in enumerate(chunks)]
-        results = await asyncio.gather(*tasks)
-        
-        print("翻译完成，正在写入文件...")
-        final_text = '\n\n'.join(results) + '\n'
-        self.output_file.write_text(final_text, encoding='utf-8')
-        print(f"已保存到: {self.output_file}")
 
-async def main():
-    import argparse
-    
-    parser = argparse.ArgumentParser(description='字幕翻译工具')
-    parser.add_argument('input_file', help='输入字幕文件路径')
-    parser.add_argument('output_file', help='输出字幕文件路径')
-    parser.add_argument('model_name', help='​​模型名称')
+    queued = 0
+    completed = 0
+    in_flight = asyncio.Semaphore(lead.max_in_flight) if lead.max_in_flight is not None else None
+    deferred = {}  # {(中转语言的翻译器, 分块序号): [(翻译器, 分块, 上下文窗口)]}
+    unaccepted = set()  # 已分派但尚未被接受的 (翻译器, 分块序号)
+    running = {}  # {(翻译器, 分块序号): 正在执行的尝试数}
+
+    def tier(job):
+        """0：前一分块已被接受，或本次尝试不参考前文译文；1：前一分块尚未开始；2：前一分块正在翻译"""
+        translator = job.translator
+        if job.parent is not None or translator.echo_context or translator.context_size + job.attempt == 0:
+            return 0
+        previous = (translator, job.index - 1)
+        if previous not in unaccepted:
+            return 0
+        return 2 if running.get(previous) else 1
+
+    queue = ChunkQueue(tier, lookahead=2 * lead.max_concurrent)
+    pivots = {translator.pivot for translator in translators if translator.pivot is not None}
+    pivot_done = set()  # 其他语言尚未全部分派时就已完成的中转分块，只含正在分派的分块
+    dispatching = None  # 生产者正在分派的分块序号
+
+    def put(job):
+        queue.put_nowait(job)
+
+    def retry(job):
+        """本次尝试失败，放回队列重试；超过最大重试次数时整个任务失败"""
+        job.attempt += 1
+        if job.attempt < job.translator.max_retries:
+            put(job)
+            return
+        start_num, end_num = job.chunk[0][0], job.chunk[-1][0]
+        translator = job.translator
+        logging.error(f"翻译块 {start_num}-{end_num} 失败，已尝试上下文大小范围: {translator.context_size}-{translator.context_size+translator.max_retries-1}")
+        if job.parent is None:
+            raise Exception(f"翻译块 {start_num}-{end_num} 失败，超过最大重试次数")
+        # 拆分出的半块失败时放弃这次拆分，父任务继续重试
+        parent, _ = job.parent
+        logging.error(f"拆分任务处理失败: 翻译块 {start_num}-{end_num} 超过最大重试次数")
+        cancel_children(parent)
+        retry(parent)
+
+    def cancel_children(job):
+        for child in job.children:
+            child.cancelled = True
+            cancel_children(child)
+        job.children = []
+        job.halves = None
+
+    def finish(job, result):
+        nonlocal completed
+        if job.parent is not None:
+            parent, part = job.parent
+            parent.halves[part] = result
+            if None in parent.halves:
+                return
+            first_half, second_half = (child.chunk for child in parent.children)
+            try:
+                combined = parent.translator._merge_halves(parent.chunk, first_half, second_half, *parent.halves)
+            except Exception as e:
+                logging.error(f"拆分任务处理失败: {str(e)}")
+                cancel_children(parent)
+                retry(parent)
+                return
+            parent.children = []
+            finish(parent, combined)
+            return
+
+        completed += 1
+        if total is not None:
+            print(f"进度: {completed}/{total_chunks} ({completed/total_chunks*100:.1f}%)")
+        else:
+            print(f"进度: {completed}/{queued}")
+        unaccepted.discard((job.translator, job.index))
+        job.translator._write_ready(job.index, job.output_chunk, result)
+        # 中转语言的分块被接受后，才分派其他语言的同一分块，使其能以中转译文为原文
+        if job.translator in pivots and job.index == dispatching:
+            pivot_done.add((job.translator, job.index))
+        for translator, chunk, window in deferred.pop((job.translator, job.index), []):
+            submit_from_pivot(translator, job.index, chunk, window)
+
+    async def step(job):
+        """执行任务的一次尝试：拆分，或者翻译一次"""
+        translator = job.translator
+        if job.attempt == 0:
+            print(f"{translator.label}开始翻译字幕块 {job.chunk[0][0]}-{job.chunk[-1][0]} (深度: {job.depth})")
+        if translator._should_split(job.chunk, job.attempt):
+            print(f"第 {job.attempt} 次重试，拆分任务...")
+            job.halves = [None, None]
+            job.children = [
+                ChunkJob(translator, job.index, half, job.window, job.priority, job.depth + 1, parent=(job, part))
+                for part, half in enumerate(translator._split_chunk(job.chunk))
+            ]
+            for child in job.children:
+                put(child)
+            return
+        result, job.last_suggestion = await translator._translate_attempt(job.chunk, job.window, job.attempt, job.last_suggestion)
+        if job.cancelled:
+            return
+        if result is not None:
+            finish(job, result)
+        else:
+            retry(job)
+
+    async def worker():
+        while True:
+            job = await queue.get()
+            key = (job.translator, job.index)
+            running[key] = running.get(key, 0) + 1
+            try:
+                if not job.cancelled:
+                    await step(job)
+            finally:
+                running[key] -= 1
+                if not running[key]:
+                    del running[key]
+                queue.task_done()
+
+    def submit(translator, index, chunk, window, source=None, source_window=None):
+        """分派分块；source / source_window 为实际翻译的原文（中转模式下可能是中转语言的译文）"""
+        job = ChunkJob(translator, index, source or chunk, source_window or window,
+                       (lead._timestamp_to_ms(chunk[0][1]), translators.index(translator), index))
+        job.output_chunk = chunk
+        put(job)
+
+    def submit_from_pivot(translator, index, chunk, window):
+        source, source_window = translator._pivot_source(chunk, window)
+        submit(translator, index, chunk, window, source, source_window)
+
+    async def produce():
+        nonlocal queued, dispatching
+        for index, (chunk, window, result) in enumerate(lead._iter_chunks(subtitles, carried)):
+            dispatching = index
+            for translator in translators:
+                if in_flight is not None:
+                    # 等待最早的分块写入后再继续读取和分派
+                    await in_flight.acquire()
+                if result is not None:
+                    translator._write_ready(index, chunk, result)
+                    continue
+                queued += 1
+                unaccepted.add((translator, index))
+                if translator.pivot is None:
+                    submit(translator, index, chunk, window)
+                elif (translator.pivot, index) in pivot_done:
+                    submit_from_pivot(translator, index, chunk, window)
+                else:
+                    # 等中转语言的该分块被接受后再分派，见 finish
+                    deferred.setdefault((translator.pivot, index), []).append((translator, chunk, window))
+            # 该分块的所有语言都已分派，不再需要记录中转分块是否完成
+            dispatching = None
+            pivot_done.clear()
+            # 让出事件循环，使已就绪的分块立即开始翻译
+            await asyncio.sleep(0)
+        await queue.join()
+
+    for translator in translators:
+        translator._open_output(in_flight)
+    workers = [asyncio.create_task(worker()) for _ in range(lead.max_concurrent)]
+    producer = asyncio.create_task(produce())
+    completed_all = False
+    try:
+        # 任一分块最终失败时工作协程会带着异常退出，此时立即停止
+        done, _ = await asyncio.wait([producer, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        completed_all = True
+    finally:
+        for task in [producer, *workers]:
+            task.cancel()
+        for translator in translators:
+            translator._close_output(completed_all)
+
+async def translate_targets(translators: List[SubtitleTranslator], pivot: str = None):
+    """多目标语言翻译：输入只解析、分块一次，各语言共享并发额度，缓存按语言分开
+
+    指定 pivot 时，其余语言的每个分块在中转语言的同一分块被接受后才分派，中转译文的 token 数更少时以其为原文翻译。
+    """
+    if pivot is not None:
+        pivot_translator = next(t for t in translators if t.target_language == pivot)
+        translators = [pivot_translator] + [t for t in translators if t is not pivot_translator]
+        for translator in translators[1:]:
+            translator.pivot = pivot_translator
+    subtitles, total = translators[0]._read_input()
+    await run_translation(translators, subtitles, total=total)
+
+def _parse_think(value):
+    """解析 think 参数：on/off 或思考强度 low/medium/high，配置文件中也可以直接写 true/false"""
+    if isinstance(value, bool):
+        return value
+    if value in ('on', 'off'):
+        return value == 'on'
+    if value in ('low', 'medium', 'high'):
+        return value
+    raise argparse.ArgumentTypeError(f"无效的 think 取值: {value}")
+
+def _parse_num_predict(value):
+    """解析 num_predict 参数：正整数或 auto"""
+    if value == 'auto':
+        return value
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if isinstance(value, bool) or number < 1:
+        raise argparse.ArgumentTypeError(f"无效的最大生成 token 数: {value}")
+    return number
+
+def add_translation_arguments(parser):
+    """添加 translate.py 与 pipeline.py 共用的翻译参数"""
     parser.add_argument('--chunk-size', type=int, default=30, help='每次翻译的字幕数量(默认: 30)')
     parser.add_argument('--max-concurrent', type=int, default=10, help='最大并发数(默认: 10)')
     parser.add_argument('--context-size', type=int, default=0, help='翻译时包含的上下文字幕数量(默认: 0)')
     parser.add_argument('--split-retry', type=int, default=3, help='每N次重试后拆分任务(默认: 3)')
     parser.add_argument('--keep-punctuation', action='store_true',
                    help='保留字幕末尾的标点符号（默认会去除）')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                   help='最多同时处理（已分派但尚未写入）的分块数，开启后逐块读取输入，内存占用与文件长度无关(默认: 不限制)')
+    parser.add_argument('--quality-threshold', type=float, default=5.0, help='质量评分通过阈值(默认: 5.0)')
+    parser.add_argument('--adaptive-threshold', action='store_true',
+                   help='启动时根据当前模型在当前目标语言上的历史评分下调通过阈值（最多下调 1 分）')
+    parser.add_argument('--echo-context', action='store_true',
+                   help='让模型连同上下文字幕一起翻译并输出（旧行为），默认上下文只作为参考，不需要模型输出')
+    parser.add_argument('--profile', metavar='DIR',
+                   help='开启性能分析，按阶段统计本地处理耗时和内存分配，结果保存到 DIR')
+    add_generation_arguments(parser)
+
+def check_translation_arguments(parser, args):
+    """检查共用翻译参数的取值，并读取生成参数配置；取值无效时通过 parser.error 退出"""
+    if args.max_in_flight is not None and args.max_in_flight < 1:
+        parser.error('--max-in-flight 必须大于等于 1')
+    if args.num_ctx is not None and args.num_ctx < 1:
+        parser.error('--num-ctx 必须大于等于 1')
+    try:
+        args.generation_profiles = generation_profiles_from_args(args)
+    except OSError as e:
+        parser.error(f"无法读取生成参数配置文件: {e}")
+    except ValueError as e:
+        # json.JSONDecodeError 也是 ValueError
+        parser.error(f"生成参数配置无效: {e}")
+
+def translator_options_from_args(args) -> dict:
+    """把共用翻译参数转换成 SubtitleTranslator 的关键字参数，需先调用 check_translation_arguments"""
+    return {
+        'chunk_size': args.chunk_size,
+        'max_concurrent': args.max_concurrent,
+        'context_size': args.context_size,
+        'split_retry': args.split_retry,
+        'keep_punctuation': args.keep_punctuation,
+        'generation_profiles': args.generation_profiles,
+        'max_in_flight': args.max_in_flight,
+        'quality_threshold': args.quality_threshold,
+        'adaptive_threshold': args.adaptive_threshold,
+        'echo_context': args.echo_context,
+    }
+
+def add_generation_arguments(parser):
+    """添加各阶段生成参数相关的命令行参数"""
+    parser.add_argument('--generation-config', help='生成参数配置文件(JSON)，形如 {"translate": {...}, "quality_check": {...}}')
+    for stage, flag in (('translate', 'translate'), ('quality_check', 'quality')):
+        parser.add_argument(f'--{flag}-think', type=_parse_think, dest=f'{stage}_think',
+                            help=f'{stage} 阶段是否启用思考: on/off/low/medium/high')
+        parser.add_argument(f'--{flag}-max-tokens', type=_parse_num_predict, dest=f'{stage}_num_predict',
+                            help=f'{stage} 阶段最大生成 token 数，auto 表示按分块长度估算(默认: auto)')
+        parser.add_argument(f'--{flag}-temperature', type=float, dest=f'{stage}_temperature',
+                            help=f'{stage} 阶段的 temperature')
+    parser.add_argument('--num-ctx', type=int, help='模型上下文长度 num_ctx（各阶段通用）')
+    parser.add_argument('--keep-alive', help='模型在内存中的保留时间，如 5m、-1（各阶段通用）')
+
+def generation_profiles_from_args(args) -> dict:
+    """合并配置文件与命令行参数，命令行参数优先"""
+    import json
+    profiles = {stage: {} for stage in DEFAULT_GENERATION_PROFILES}
+    if args.generation_config:
+        config = json.loads(Path(args.generation_config).read_text(encoding='utf-8'))
+        if not isinstance(config, dict):
+            raise ValueError("配置文件的顶层必须是对象")
+        for stage, profile in config.items():
+            if stage not in profiles:
+                raise ValueError(f"未知的生成阶段: {stage}")
+            if not isinstance(profile, dict):
+                raise ValueError(f"{stage} 阶段的生成参数必须是对象")
+            unknown = set(profile) - set(GENERATION_KEYS)
+            if unknown:
+                raise ValueError(f"{stage} 阶段存在未知的生成参数: {', '.join(sorted(unknown))}")
+            profile = dict(profile)
+            try:
+                if 'think' in profile:
+                    profile['think'] = _parse_think(profile['think'])
+                if profile.get('num_predict') is not None:
+                    profile['num_predict'] = _parse_num_predict(profile['num_predict'])
+                num_ctx = profile.get('num_ctx')
+                if num_ctx is not None and (isinstance(num_ctx, bool) or not isinstance(num_ctx, int) or num_ctx < 1):
+                    raise argparse.ArgumentTypeError(f"无效的 num_ctx: {num_ctx}")
+            except argparse.ArgumentTypeError as e:
+                raise ValueError(f"{stage} 阶段的生成参数无效: {e}")
+            profiles[stage].update(profile)
+    keep_alive = args.keep_alive
+    if keep_alive is not None and re.fullmatch(r'-?\d+(\.\d+)?', keep_alive):
+        keep_alive = float(keep_alive)
+    for stage, profile in profiles.items():
+        for key in ('think', 'num_predict', 'temperature'):
+            value = getattr(args, f'{stage}_{key}')
+            if value is not None:
+                profile[key] = value
+        if args.num_ctx is not None:
+            profile['num_ctx'] = args.num_ctx
+        if keep_alive is not None:
+            profile['keep_alive'] = keep_alive
+    return profiles
+
+async def main():
+    parser = argparse.ArgumentParser(description='字幕翻译工具')
+    parser.add_argument('input_file', help='输入字幕文件路径')
+    parser.add_argument('output_file', help='输出字幕文件路径')
+    parser.add_argument('model_name', help='​​模型名称')
+    add_translation_arguments(parser)
+    parser.add_argument('--incremental', action='store_true',
+                   help='增量翻译：复用上次的翻译结果，只重新翻译文本有改动的字幕及其相邻字幕')
+    parser.add_argument('--targets', type=lambda value: [t.strip() for t in value.split(',') if t.strip()],
+                   help='目标语言列表，如 zh,ja,ko；多个语言时输出文件名会加上语言后缀，如 output.ja.srt')
+    parser.add_argument('--pivot', help='中转语言（须在 --targets 中），其余语言等其同一分块被接受后再翻译，其译文 token 数更少时以其为原文')
     args = parser.parse_args()
+    check_translation_arguments(parser, args)
+    if args.incremental and args.max_in_flight is not None:
+        parser.error('--incremental 需要完整的字幕列表，不能与 --max-in-flight 同时使用')
+    if args.targets and len(set(args.targets)) != len(args.targets):
+        duplicates = sorted({target for target in args.targets if args.targets.count(target) > 1})
+        parser.error(f"--targets 中的语言重复: {', '.join(duplicates)}")
+    if args.pivot and args.pivot not in (args.targets or []):
+        parser.error('--pivot 指定的语言必须在 --targets 中')
+    if args.incremental and args.targets and len(args.targets) > 1:
+        parser.error('--incremental 只支持单个目标语言')
+
+    def create_translator(output_file, target_language=None):
+        return SubtitleTranslator(
+            input_file=args.input_file,
+            output_file=output_file,
+            model_name=args.model_name,
+            incremental=args.incremental,
+            target_language=target_language,
+            **translator_options_from_args(args)
+        )
+
+    if not args.targets:
+        translators = [create_translator(args.output_file)]
+    elif len(args.targets) == 1:
+        translators = [create_translator(args.output_file, args.targets[0])]
+    else:
+        output = Path(args.output_file)
+        translators = [
+            create_translator(output.with_name(f"{output.stem}.{target}{output.suffix}"), target)
+            for target in args.targets
+        ]
 
-    translator = SubtitleTranslator(
-        input_file=args.input_file,
-        output_file=args.output_file,
-        model_name=args.model_name,
-        chunk_size=args.chunk_size,
-        max_concurrent=args.max_concurrent,
-        context_size=args.context_size,
-        split_retry=args.split_retry,
-        keep_punctuation=args.keep_punctuation
-    )
-    await translator.translate()
+    profiler = None
+    if args.profile:
+        from profiling import StageProfiler
+        profiler = StageProfiler(args.profile)
+        for translator in translators:
+            profiler.wrap_methods(translator, PROFILED_METHODS)
+        profiler.start()
+    try:
+        if len(translators) == 1:
+            await translators[0].translate()
+        else:
+            await translate_targets(translators, pivot=args.pivot)
+    finally:
+        if profiler is not None:
+            profiler.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file